@@ -1,57 +1,13 @@
+import re
 import sys
-import graphviz
-import heapq as hq
-
-class Edge:
-    """
-    class Edge to represent the distance between two nodes
-    (or taxa in a phylogenetic tree application)
-
-    Fields:
-        distance : float - distance (physical or evolutionary) between nodes
-        node1 : str - node1 and node2 ordered st that node1 < node2 lexographically
-        node2 : str
-    """
-  # constructor
-    def __init__(self, dist, n1, n2):
-        """ Constructor for class Edge to represent the distance between two nodes.
-
-            :param dist: float distance between the two nodes
-            :param n1: string rep of first node
-            :param n2: string rep of second node
-        """
-        self.distance = dist
-        self.node1 = n1
-        self.node2 = n2
-  
-   # override the comparison operator
-    def __lt__(self, nxt):
-        """ Returns true if first Edge has lower distance
-            If tied for distance, returns true for first lexicographically less than second
-        """
-        if self.distance == nxt.distance:
-            return str(order_pair(self.node1, self.node2)) <\
-                   str(order_pair(nxt.node1, nxt.node2))
-        else: 
-            return self.distance < nxt.distance
-
-class NodeInfo:
-    """
-        class NodeInfo to contain data accumulated about a node/cluster
-        used as values in node_dict mapping node names with commas + parens
-        to NodeInfo objects
-    """
-    #constructor
-    def __init__(self, size, level, name):
-        """ Constructor for class to contain data accumulated about a node
-
-            :param size: int - number of nodes contained within this node/cluster
-            :param level: int - upgma height for DOT diagram
-            :param name: str - shorthand name for the node (ie no parentheses and commas)
-        """
-        self.size = size
-        self.level = level
-        self.name = name
+import warnings
+import numpy as np
+from numba import njit
+
+# DOT identifiers that graphviz leaves unquoted: ASCII names and numerals
+DOT_PLAIN_ID = re.compile(r"[a-zA-Z_][a-zA-Z0-9_]*|-?(\.[0-9]+|[0-9]+(\.[0-9]*)?)")
+# double quotes not already escaped by a backslash, which graphviz escapes when quoting
+DOT_UNESCAPED_QUOTE = re.compile(r'(?P<backslashes>(?:\\{2})*)\\?"')
 
 def parse_args():
     """
@@ -62,194 +18,243 @@ def parse_args():
     Parameters: NA
 
     Returns: 
-        distances : list(str) representing pairwise distances
+        distance_file : str is filepath of pairwise distances
         write_to_file : str is filepath to write result to
     """
-    distances = open(sys.argv[1],'r').readlines()
-    distances = [dist for dist in distances if dist != "\n" and dist != " "]
+    distance_file = sys.argv[1]
     write_to_file = sys.argv[2]
-    return distances, write_to_file
+    return distance_file, write_to_file
 
-def order_pair(node1, node2):
-    """
-    Consumes 2 nodes, returns them as a tuple in lexicographic order
+def instantiate_distances(distance_file):
+    """ Reads pairwise distances, returns data structures to be used in neighbor-joining.
+        Taxa are given integer cluster ids in lexicographic order of their names;
+        the cluster formed by the k-th merge gets id n_taxa + k.
 
-        :param node1: - str
-        :param node2: - str
+        :param distance_file: str filepath of lines "node1 node2 distance"
 
-    Returns
-        ordered_pair : tuple(str, str)
+    Returns:
+        dist_matrix : np.ndarray[float64] (n, n) - symmetric distances between taxon ids,
+                      inf on the diagonal
+        size : np.ndarray[int32] (2n) - number of taxa contained within each cluster
+        level : np.ndarray[int32] (2n) - upgma height of each cluster for DOT diagram
+        active : np.ndarray[bool] (2n) - True for clusters that have not been merged yet
+        labels : dict[int, str] mapping each taxon id to its name
+
+    Raises:
+        ValueError if the distance between some pair of taxa is missing or not finite
     """
-    if node1 < node2:
-        ordered_pair = (node1, node2)
-    else:
-        ordered_pair = (node2, node1)
-    return ordered_pair
-
-def instantiate_distances(distances):
-    """ Consumes list of distances, returns data structures to be used in neighbor-joining.
-
-        :param distances: list(str) representing pairwise distances
-
-    Returns: 
-        distance_heap : heapq of Edges sorted by distance
-        node_dict : dict[str, NodeInfo] mapping each cluster to number of member nodes
-        distance_dict : dict[(str, str), float] mapping tuple of nodes to distance
-                                                between the members of the pair
-
-    """
-    distance_heap, node_dict, dist_dict = [], {}, {}
-
-    for dist in distances:
-        nodes_dist = dist.split()
-        node1, node2, distance = nodes_dist[0], nodes_dist[1], float(nodes_dist[2])
-        if node1 < node2: 
-            new_edge = Edge(distance, node1, node2)
-        else: 
-            new_edge = Edge(distance, node2, node1)
-        dist_dict[order_pair(node1, node2)] = distance
-        ONE_NODE_START = 1
-        ZERO_UPGMA_HEIGHT = 0
-        node_dict[node1] = NodeInfo(ONE_NODE_START, ZERO_UPGMA_HEIGHT, node1)
-        node_dict[node2] = NodeInfo(ONE_NODE_START, ZERO_UPGMA_HEIGHT, node2)
-        hq.heappush(distance_heap, new_edge)
-    return distance_heap, node_dict, dist_dict
-
-def calc_distance(node, union, node_dict, dist_dict):
+    with warnings.catch_warnings():
+        # blank lines and empty files are expected, don't warn about them
+        warnings.simplefilter("ignore", UserWarning)
+        columns = np.loadtxt(distance_file, dtype=str, usecols=(0, 1, 2), ndmin=2, comments=None)
+    # np.unique sorts, so ids follow lexicographic order of the names
+    taxa, node_ids = np.unique(columns[:, :2].ravel(), return_inverse=True)
+    node_ids = node_ids.reshape(-1, 2)
+    edges_dist = columns[:, 2].astype(np.float64)
+
+    n_clusters = 2 * len(taxa)
+    dist_matrix = np.full((len(taxa), len(taxa)), np.inf, dtype=np.float64)
+    dist_matrix[node_ids[:, 0], node_ids[:, 1]] = edges_dist
+    dist_matrix[node_ids[:, 1], node_ids[:, 0]] = edges_dist
+    missing = ~np.isfinite(dist_matrix)
+    np.fill_diagonal(missing, False)
+    if missing.any():
+        node1, node2 = np.argwhere(missing)[0]
+        raise ValueError(f"no finite distance given between {taxa[node1]} and {taxa[node2]}")
+    size = np.ones(n_clusters, dtype=np.int32)
+    level = np.zeros(n_clusters, dtype=np.int32)
+    active = np.zeros(n_clusters, dtype=bool)
+    active[:len(taxa)] = True
+    labels = dict(enumerate(taxa.tolist()))
+    return dist_matrix, size, level, active, labels
+
+@njit(cache=True)
+def calc_distance(node, union_i, union_j, num_items_i, num_items_j, dist_matrix):
     """
     Calculates the distance between a given node and the newly unioned node
-    
-    Parameters: 
-        :param node: - str rep of any node
-        :param union: - Edge that has just been added to the graph
-        :param node_dict: - dict[node: NodeInfo] mapping string node to it's NodeInfo
-        :param dist_dict: - dict[(node1, node2): distance] mapping pair to the distance between them
+
+    Parameters:
+        :param node: - int slot of any node
+        :param union_i: - int slot of first member of the union
+        :param union_j: - int slot of second member of the union
+        :param num_items_i: - int number of taxa in first member of the union
+        :param num_items_j: - int number of taxa in second member of the union
+        :param dist_matrix: - np.ndarray[float64] distances between slots
 
     Returns:
         distance : float
     """
-    node_to_ui = dist_dict[order_pair(union.node1, node)]
-    node_to_uj = dist_dict[order_pair(union.node2, node)]
-    num_items_i, num_items_j = node_dict[union.node1].size, node_dict[union.node2].size
-    coeff_i = num_items_i / (num_items_i + num_items_j)
-    coeff_j = num_items_j / (num_items_i + num_items_j)
-    distance = (coeff_i * node_to_ui) + (coeff_j * (node_to_uj)) 
-    return distance
+    return (num_items_i * dist_matrix[union_i, node] + num_items_j * dist_matrix[union_j, node])\
+           / (num_items_i + num_items_j)
 
-def update_heap_and_dict(cluster, dist_heap, node_dict, dist_dict):
+@njit(cache=True)
+def edge_less(dist_matrix, slot_ids, s, t, u, v):
+    """
+    Returns true if the edge between slots s and t sorts before the edge between
+    slots u and v, comparing by distance and then by the ordered pair of cluster ids
+    """
+    if dist_matrix[s, t] != dist_matrix[u, v]:
+        return dist_matrix[s, t] < dist_matrix[u, v]
+    st_lo, st_hi = min(slot_ids[s], slot_ids[t]), max(slot_ids[s], slot_ids[t])
+    uv_lo, uv_hi = min(slot_ids[u], slot_ids[v]), max(slot_ids[u], slot_ids[v])
+    if st_lo != uv_lo:
+        return st_lo < uv_lo
+    return st_hi < uv_hi
+
+@njit(cache=True)
+def closest_slot(dist_matrix, slot_ids, slots, n_active, s):
+    """
+    Returns the active slot whose edge to slot s sorts first, -1 if there is none
     """
-    Updates given distance_heap to reflect union of nodes in given cluster
+    best = -1
+    for k in range(n_active):
+        t = slots[k]
+        if t != s and (best < 0 or edge_less(dist_matrix, slot_ids, s, t, s, best)):
+            best = t
+    return best
+
+@njit(cache=True)
+def merge_clusters(dist_matrix, size, level, active):
+    """
+    Runs every UPGMA merge, always joining the closest pair of active clusters.
+    Each union is written into the slot of one of its members and the other slot
+    is retired, so dist_matrix never grows; slot_ids maps slots to cluster ids.
 
-    Parameters: 
-        cluster : Edge containing nodes being clustered
-        dist_heap : heap(Edge)
-        node_dict : dict[node: int]
-        dist_dict : dict[(node1, node2): float]
+    Parameters:
+        dist_matrix : np.ndarray[float64] (n, n) - distances between slots
+        size : np.ndarray[int32] (2n)
+        level : np.ndarray[int32] (2n)
+        active : np.ndarray[bool] (2n)
 
-    Returns: 
-        updated distance_heap and distance_dict
-
-    Side affects: 
-        Adds distances to the given distances_heap between union of closest_nodes
-        and every non-member node in the nodes_set
-        Removes elements which contain individual members of new union
-    """
-    valid_edge = lambda dist :\
-            dist.node1 != cluster.node1\
-        and dist.node1 != cluster.node2\
-        and dist.node2 != cluster.node1\
-        and dist.node2 != cluster.node2
-    #update dist_heap by taking out edges to now-unioned nodes
-    new_dist_heap = []
-    [hq.heappush(new_dist_heap, dist) for dist in list(dist_heap) if valid_edge(dist)]
-
-    # add new distances from cluster to heap and dict
-    nodes = [node for node in node_dict.keys() if node != cluster.node1 and node != cluster.node2]
-    for node in nodes:
-        new_dist = calc_distance(node, cluster, node_dict, dist_dict)
-        cluster_name = "(" + cluster.node1 + "," + cluster.node2 + ")"
-        if node < cluster_name:
-            new_edge = Edge(new_dist, node, cluster_name)
-        else:
-            new_edge = Edge(new_dist, cluster_name, node)
-        hq.heappush(new_dist_heap, new_edge)
-        dist_dict[order_pair(node, cluster_name)] = new_dist
-
-    return new_dist_heap, dist_dict
-
-def update_node_dict(cluster, node_dict):
-    """
-    Updates given node_dict to reflect union of given cluster
-
-    Parameters: 
-        cluster : Edge containing nodes being clustered
-        node_dict : dict[str: NodeInfo(size, level)]
+    Returns:
+        linkage : np.ndarray[int64] (n - 1, 2) - ids of the clusters joined by the k-th
+                  merge, which forms cluster n + k
 
-    Returns: 
-        updated node_dict
+    Side affects:
+        Overwrites dist_matrix
+        Fills in size, level and active for every union
     """
-    # save components of new dict entry
-    new_union = "(" + cluster.node1 + "," + cluster.node2 + ")"
-    new_node_count = node_dict[cluster.node1].size + node_dict[cluster.node2].size
-    new_node_level = max(node_dict[cluster.node1].level, node_dict[cluster.node2].level) + 1
-    new_node_name = node_dict[cluster.node1].name + node_dict[cluster.node2].name
-    # add entry for new unioned node
-    node_dict[new_union] = NodeInfo(new_node_count, new_node_level, new_node_name)
-
-    return node_dict
+    n_taxa = len(dist_matrix)
+    n_merges = max(n_taxa - 1, 0)
+    slot_ids = np.arange(n_taxa)
+    # active slots are kept in slots[:n_active]
+    slots = np.arange(n_taxa)
+    # closest slot of every active slot, only rescanned when it gets merged away
+    row_min = np.empty(n_taxa, dtype=np.int64)
+    for s in range(n_taxa):
+        row_min[s] = closest_slot(dist_matrix, slot_ids, slots, n_taxa, s)
+
+    linkage = np.empty((n_merges, 2), dtype=np.int64)
+    for step in range(n_merges):
+        new_id = n_taxa + step
+        n_active = n_taxa - step
+        # the closest pair overall is the closest pair of one of the rows
+        slot1 = slots[0]
+        for k in range(1, n_active):
+            s = slots[k]
+            if edge_less(dist_matrix, slot_ids, s, row_min[s], slot1, row_min[slot1]):
+                slot1 = s
+        slot2 = row_min[slot1]
+        node1, node2 = slot_ids[slot1], slot_ids[slot2]
+        linkage[step, 0], linkage[step, 1] = min(node1, node2), max(node1, node2)
+
+        size[new_id] = size[node1] + size[node2]
+        level[new_id] = max(level[node1], level[node2]) + 1
+        active[node1] = active[node2] = False
+        active[new_id] = True
+
+        # retire slot2 and write the union into slot1
+        for k in range(n_active):
+            if slots[k] == slot2:
+                slots[k] = slots[n_active - 1]
+                break
+        n_active -= 1
+        for k in range(n_active):
+            t = slots[k]
+            if t != slot1:
+                new_dist = calc_distance(t, slot1, slot2, size[node1], size[node2], dist_matrix)
+                dist_matrix[slot1, t] = dist_matrix[t, slot1] = new_dist
+        slot_ids[slot1] = new_id
+
+        row_min[slot1] = closest_slot(dist_matrix, slot_ids, slots, n_active, slot1)
+        for k in range(n_active):
+            t = slots[k]
+            if t == slot1:
+                continue
+            if row_min[t] == slot1 or row_min[t] == slot2:
+                row_min[t] = closest_slot(dist_matrix, slot_ids, slots, n_active, t)
+            elif edge_less(dist_matrix, slot_ids, t, slot1, t, row_min[t]):
+                row_min[t] = slot1
+    return linkage
+
+def dot_id(name):
+    """
+    Returns given node name as a DOT identifier, quoting it the way graphviz does
+    unless it is a plain ID. Names containing ':' are quoted whole rather than
+    split into node:port as graphviz.Graph.edge would.
 
-def add_graph_cluster(dot_output, cluster, node_dict):
+        :param name: - str
     """
-    Adds edges to given Graph object to represent given cluster
+    if DOT_PLAIN_ID.fullmatch(name):
+        return name
+    return '"' + DOT_UNESCAPED_QUOTE.sub(r'\g<backslashes>\\"', name) + '"'
 
-    Parameters: 
-        dot_output : Graph - graph object to add edges to
-        cluster : Edge - cluster being formed
-        node_dict : dict(str, NodeInfo) - maps names of current nodes to NodeInfo
-    
-    Returns: 
-        updated Graph object with edges from latest cluster
+def add_graph_cluster(dot_lines, node1, node2, new_id, level, names, dot_nodes):
     """
-    node1, node2 = cluster.node1, cluster.node2
-    node1_level, node2_level  = node_dict[node1].level, node_dict[node2].level
+    Adds DOT edge statements to given list of lines to represent given cluster
 
-    cluster_name = "(" + cluster.node1 + "," + cluster.node2 + ")"
-    union_level = node_dict[cluster_name].level
-    union_name = node_dict[cluster_name].name + str(union_level)
+    Parameters:
+        dot_lines : list(str) - lines of the DOT graph to add edges to
+        node1, node2 : int - ids of the clusters being joined
+        new_id : int - cluster id given to the union
+        level : np.ndarray[int32] (2n) - upgma height of each cluster
+        names : dict[int, str] - shorthand name (ie no parentheses and commas) of each cluster
+        dot_nodes : dict[int, str] - DOT node id (shorthand name + level) of each cluster,
+                                     filled in once when the cluster is formed
 
-    dot_output.edge(node_dict[node1].name + str(node1_level), union_name)
-    dot_output.edge(node_dict[node2].name + str(node2_level), union_name)
+    Returns: NA
+    """
+    union = names[new_id] = names[node1] + names[node2]
+    union_name = dot_nodes[new_id] = dot_id(union + str(level[new_id]))
 
-    return dot_output
+    dot_lines.append(f"\t{dot_nodes[node1]} -- {union_name}")
+    dot_lines.append(f"\t{dot_nodes[node2]} -- {union_name}")
 
-def main(distances, output_file):
+def main(distance_file, output_file):
     """
-    Outputs the cluster pattern in terminal and writes graphviz graph to given dot file
+    Outputs the cluster pattern in terminal and writes DOT graph to given dot file
 
-    Parameters: 
-        distances : list(str) representing all original graph edges
+    Parameters:
+        distance_file : str - filepath of all original graph edges
         output_file : str - filepath to write output to
 
     Returns: NA
 
-    Side affects: 
+    Side affects:
     Prints clustering pattern to terminal
-    Writes a phylogenetic treeg in DOT format to input .dot file 
-    """
-    distance_heap, node_dict, distance_dict = instantiate_distances(distances)
-    dot_output = graphviz.Graph('tree')
-    while len(node_dict) > 1:
-        cluster = hq.heappop(distance_heap)
-        distance_heap, distance_dict = update_heap_and_dict(cluster, distance_heap, node_dict, distance_dict)
-        node_dict = update_node_dict(cluster, node_dict)
-        dot_output = add_graph_cluster(dot_output, cluster, node_dict)
-        # delete entries for old nodes - used to break while-loop
-        del node_dict[cluster.node1]
-        del node_dict[cluster.node2]
-
-    [sys.stdout.write(key) for key in node_dict.keys()]
-    dot_output.save(output_file)
+    Writes a phylogenetic treeg in DOT format to input .dot file
+    """
+    dist_matrix, size, level, active, labels = instantiate_distances(distance_file)
+    n_taxa = len(labels)
+    linkage = merge_clusters(dist_matrix, size, level, active)
+
+    names = dict(labels)
+    dot_nodes = {node: dot_id(name + "0") for node, name in names.items()}
+    dot_lines = ["graph tree {"]
+    for step, (node1, node2) in enumerate(linkage.tolist()):
+        new_id = n_taxa + step
+        # name members of the union in lexicographic order of their labels
+        label1, label2 = labels[node1], labels[node2]
+        if label2 < label1:
+            node1, node2, label1, label2 = node2, node1, label2, label1
+        labels[new_id] = "(" + label1 + "," + label2 + ")"
+        add_graph_cluster(dot_lines, node1, node2, new_id, level, names, dot_nodes)
+
+    sys.stdout.writelines(labels[node] for node in np.flatnonzero(active))
+    dot_lines.append("}")
+    with open(output_file, 'w') as dot_file:
+        dot_file.write("\n".join(dot_lines) + "\n")
 
 if __name__ == "__main__":
-    distances, write_to_file = parse_args()
-    main(distances, write_to_file)
\ No newline at end of file
+    distance_file, write_to_file = parse_args()
+    main(distance_file, write_to_file)